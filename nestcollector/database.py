@@ -2,25 +2,72 @@
 Module containing the Database class, which is used to connect to the database and store the nests.
 """
 
+import functools
+import hashlib
 import logging
+import os
 import time
 import urllib
 
 from .models import Base, Nest
 from .timing import human_time
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.orm import sessionmaker
-from typing import List
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.expression import TextClause
+from typing import Dict, List, Optional
 
 # MariaDB connection URI
-SQLALCHEMY_DATABASE_URI = 'mariadb+pymysql://{user}:{password}@{host}:{port}/{name}?charset=utf8mb4'
+SQLALCHEMY_DATABASE_URI = 'mariadb+{driver}://{user}:{password}@{host}:{port}/{name}?charset=utf8mb4'
+
+# The seconds after which connections are recycled, before MariaDB's wait_timeout closes them
+DB_POOL_RECYCLE = 3600
+
+# Statements reused on every run, built once at import time
+PROCEDURE_CHECKSUM_QUERY = text("""
+SELECT ROUTINE_COMMENT FROM information_schema.ROUTINES
+WHERE ROUTINE_SCHEMA = DATABASE() AND ROUTINE_TYPE = 'PROCEDURE' AND ROUTINE_NAME = :name
+""")
+CALL_SPAWNPOINTS_PROCEDURE = text('CALL get_nest_spawnpoints(:minimum_spawnpoints, @discarded_nests)')
+CALL_LOW_COVERAGE_PROCEDURE = text('CALL nest_filter_low_coverage(:minimum_coverage, @discarded_nests)')
+CALL_OVERLAPPING_PROCEDURE = text('CALL nest_filter_overlap(:maximum_overlap, @discarded_nests)')
+DISCARDED_NESTS_QUERY = text('SELECT @discarded_nests')
+COUNT_ACTIVE_NESTS_QUERY = select(func.count()).select_from(Nest).where(Nest.active == 1)
+
+# Engines shared by every Database instance, keyed by connection URL
+_ENGINES: Dict[str, Engine] = {}
+
+# The folder of the SQL files, next to the package so it is found whatever the working directory
+SQL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql')
 
 # SQL file for creating the stored procedure
-NEST_SPAWNPOINTS_PROCEDURE = './sql/get_nest_spawnpoints.sql'
-NEST_OVERLAPPING_PROCEDURE = './sql/disable_overlapping_nests.sql'
-NEST_STATS_SPAWNPOINTS_PROCEDURE = './sql/stats/get_nest_spawnpoints.sql'
-NEST_STATS_LOW_COVERAGE_PROCEDURE = './sql/stats/disable_low_coverage_nests.sql'
+NEST_SPAWNPOINTS_PROCEDURE = os.path.join(SQL_PATH, 'get_nest_spawnpoints.sql')
+NEST_OVERLAPPING_PROCEDURE = os.path.join(SQL_PATH, 'disable_overlapping_nests.sql')
+NEST_STATS_SPAWNPOINTS_PROCEDURE = os.path.join(SQL_PATH, 'stats', 'get_nest_spawnpoints.sql')
+NEST_STATS_LOW_COVERAGE_PROCEDURE = os.path.join(SQL_PATH, 'stats', 'disable_low_coverage_nests.sql')
+
+# Columns written by save_nests, the remaining ones are kept if the nest already exists
+NEST_COLUMNS = ('nest_id', 'lat', 'lon', 'name', 'polygon', 'area_name', 'spawnpoints', 'm2')
+
+# Nests sent per multi-row INSERT, kept low as polygons can be large compared to max_allowed_packet
+NEST_INSERT_BATCH_SIZE = 500
+
+
+@functools.lru_cache(maxsize=None)
+def read_procedure(path: str) -> str:
+    """
+    Reads the SQL of a stored procedure, caching it for later calls.
+
+    Args:
+        path (str): The path to the SQL file.
+
+    Returns:
+        str: The SQL template of the stored procedure.
+    """
+    with open(path, 'r') as file:
+        return file.read()
 
 
 class Database:
@@ -28,10 +75,10 @@ class Database:
     Class for connecting to the database and storing the nests.
 
     Attributes:
-        db (sqlalchemy.orm.session.Session): The database session.
+        driver (str): The database driver.
+        session_local (sqlalchemy.orm.sessionmaker): The database session factory.
         use_stats_db (bool): Whether to use the Stats database.
         stats_name (str): The Stats database name.
-        stats_db (sqlalchemy.orm.session.Session): The Stats database session.
     """
 
     def __init__(
@@ -41,12 +88,9 @@ class Database:
             name: str,
             user: str,
             password: str,
+            driver: str = 'pymysql',
             use_stats_db: bool = False,
-            stats_host: str = None,
-            stats_port: str = None,
-            stats_name: str = None,
-            stats_user: str = None,
-            stats_password: str = None
+            stats_name: str = None
         ) -> None:
         """
         Initializes the NestDatabase class.
@@ -57,26 +101,32 @@ class Database:
             name (str): The database name.
             user (str): The database user.
             password (str): The database password.
+            driver (str): The database driver, pymysql or mysqldb. Default to pymysql.
             use_stats_db (bool): Whether to use the Stats database.
-            stats_host (str): The Stats database host.
-            stats_port (str): The Stats database port.
-            stats_name (str): The Stats database name.
-            stats_user (str): The Stats database user.
-            stats_password (str): The Stats database password.
+            stats_name (str): The Stats database name, which must be reachable from the database connection.
         """
         # Parse special characters
         password = urllib.parse.quote(password)
-        stats_password = urllib.parse.quote(stats_password)
 
-        self.db = self._create_session_local(host, port, name, user, password, create_tables=True)
+        self.driver = driver
+        self.session_local = self._create_session_local(host, port, name, user, password, create_tables=True)
         self.use_stats_db = use_stats_db
         if self.use_stats_db:
             self.stats_name = stats_name
-            self.stats_db = self._create_session_local(stats_host, stats_port, stats_name, stats_user, stats_password)
 
-    def _create_session_local(self, host: str, port: str, name: str, user: str, password: str, create_tables: bool = False) -> None:
+    def _create_session_local(
+            self,
+            host: str,
+            port: str,
+            name: str,
+            user: str,
+            password: str,
+            create_tables: bool = False,
+            pool_recycle: int = DB_POOL_RECYCLE
+        ) -> sessionmaker:
         """
-        Creates the SQLAlchemy session.
+        Creates the SQLAlchemy session factory, sessions are opened per unit of work so
+        their connection is returned to the pool as soon as the work is done.
 
         Args:
             host (str): The database host.
@@ -85,100 +135,146 @@ class Database:
             user (str): The database user.
             password (str): The database password.
             create_tables (bool, Optional): Whether to create the tables if they don't exist. Default to False.
+            pool_recycle (int, Optional): The seconds after which a connection is recycled. Default to DB_POOL_RECYCLE.
+
+        Returns:
+            sqlalchemy.orm.sessionmaker: The session factory.
         """
-        # Create ORM session and create the models if they don't exist
+        # Create ORM session and create the models if they don't exist, reusing the engine if already created
         connection_url = SQLALCHEMY_DATABASE_URI.format(
+            driver=self.driver,
             host=host,
             port=port,
             name=name,
             user=user,
             password=password
         )
-        engine = create_engine(connection_url, pool_pre_ping=True)
-        if create_tables:
-            Base.metadata.create_all(bind=engine)
-        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-        return SessionLocal()
+        engine = _ENGINES.get(connection_url)
+        if engine is None:
+            engine = create_engine(
+                connection_url,
+                pool_pre_ping=True,
+                pool_recycle=pool_recycle
+            )
+            if create_tables:
+                Base.metadata.create_all(bind=engine)
+            _ENGINES[connection_url] = engine
+        return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    def _call_procedure(self, session: Session, statement: TextClause, **params) -> int:
+        """
+        Calls a filtering stored procedure.
+
+        Args:
+            session (sqlalchemy.orm.session.Session): The database session.
+            statement (sqlalchemy.sql.expression.TextClause): The CALL statement of the procedure.
+            **params: The values of the IN parameters of the procedure.
 
-    def call_low_coverage_procedure(self) -> None:
+        Returns:
+            int: The number of nests discarded by the procedure, read from its OUT parameter.
+        """
+        session.execute(statement, params)
+        return session.execute(DISCARDED_NESTS_QUERY).scalar()
+
+    def _create_procedure(self, name: str, path: str, **params) -> None:
+        """
+        Creates a stored procedure, skipping it if the existing one was created from the same SQL.
+
+        The checksum of the SQL is stored in the procedure comment, so an unchanged procedure
+        costs a single lookup in information_schema instead of a CREATE OR REPLACE.
+
+        Args:
+            name (str): The name of the stored procedure.
+            path (str): The path to the SQL file.
+            **params: The values to format the SQL with.
+        """
+        procedure = read_procedure(path)
+        checksum = hashlib.sha256(procedure.format(checksum='', **params).encode()).hexdigest()
+        with self.session_local() as session:
+            if session.execute(PROCEDURE_CHECKSUM_QUERY, {'name': name}).scalar() == checksum:
+                return
+            session.execute(text(procedure.format(checksum=checksum, **params)))
+
+    def call_low_coverage_procedure(self, session: Session, minimum_coverage: int) -> None:
         """
         Calls the stored procedure for filtering low coverage nests by mon area.
+
+        Args:
+            session (sqlalchemy.orm.session.Session): The database session.
+            minimum_coverage (int): The minimum coverage of a nest by mon area.
         """
         logging.info('Disabling low coverage by mon area nests...')
         start = time.time()
-        self.db.execute(text('CALL nest_filter_low_coverage()'))
-        self.db.commit()
+        count = self._call_procedure(session, CALL_LOW_COVERAGE_PROCEDURE, minimum_coverage=minimum_coverage)
         end = time.time()
-        count = self.db.query(Nest).filter(Nest.discarded == 'low_coverage').count()
         logging.info(f'Disabled {count} low coverage by mon area nests in {human_time(end - start)}.')
 
-    def create_low_coverage_procedure(self, minimum_coverage: int) -> None:
+    def create_low_coverage_procedure(self) -> None:
         """
         Creates the stored procedure for filtering low coverage nests by mon area.
-
-        Args:
-            minimum_coverage (int): The minimum coverage of a nest by mon area.
         """
-        self.db.execute(text(f'DROP PROCEDURE IF EXISTS nest_filter_low_coverage'))
-        with open(NEST_STATS_LOW_COVERAGE_PROCEDURE, 'r') as file:
-            procedure = file.read()
-            procedure = procedure.format(stats_db=self.stats_name, minimum_coverage=minimum_coverage)
-        self.db.execute(text(procedure))
+        self._create_procedure('nest_filter_low_coverage', NEST_STATS_LOW_COVERAGE_PROCEDURE, stats_db=self.stats_name)
 
-    def call_spawnpoints_procedure(self) -> None:
+    def call_spawnpoints_procedure(self, session: Session, minimum_spawnpoints: int) -> None:
         """
         Calls the stored procedure for counting the spawnpoints in a nest.
+
+        Args:
+            session (sqlalchemy.orm.session.Session): The database session.
+            minimum_spawnpoints (int): The minimum spawnpoints of a nest.
         """
         logging.info('Calculating and filtering spawnpoints of nests...')
         start = time.time()
-        self.db.execute(text('CALL get_nest_spawnpoints()'))
-        self.db.commit()
+        count = self._call_procedure(session, CALL_SPAWNPOINTS_PROCEDURE, minimum_spawnpoints=minimum_spawnpoints)
         end = time.time()
-        count = self.db.query(Nest).filter(Nest.discarded == 'spawnpoints').count()
         logging.info(f'Disabled {count} nests due to low number of spawnpoints in {human_time(end - start)}.')
 
-    def create_spawnpoints_procedure(self, minimum_spawnpoints: int) -> None:
+    def create_spawnpoints_procedure(self) -> None:
         """
         Creates the stored procedure for counting the spawnpoints in a nest.
-
-        Args:
-            minimum_spawnpoints (int): The minimum spawnpoints of a nest.
         """
-        self.db.execute(text(f'DROP PROCEDURE IF EXISTS get_nest_spawnpoints'))
         if self.use_stats_db:
-            with open(NEST_STATS_SPAWNPOINTS_PROCEDURE, 'r') as file:
-                procedure = file.read()
-                procedure = procedure.format(stats_db=self.stats_name, minimum_spawnpoints=minimum_spawnpoints)
+            self._create_procedure('get_nest_spawnpoints', NEST_STATS_SPAWNPOINTS_PROCEDURE, stats_db=self.stats_name)
         else:
-            with open(NEST_SPAWNPOINTS_PROCEDURE, 'r') as file:
-                procedure = file.read()
-                procedure = procedure.format(minimum_spawnpoints=minimum_spawnpoints)
-        self.db.execute(text(procedure))
+            self._create_procedure('get_nest_spawnpoints', NEST_SPAWNPOINTS_PROCEDURE)
 
-    def call_overlappping_procedure(self) -> None:
+    def call_overlappping_procedure(self, session: Session, maximum_overlap: int) -> None:
         """
         Calls the stored procedure for filtering overlapping nests.
+
+        Args:
+            session (sqlalchemy.orm.session.Session): The database session.
+            maximum_overlap (int): The maximum allowed overlap between nests.
         """
         logging.info('Disabling overlapping nests...')
         start = time.time()
-        self.db.execute(text('CALL nest_filter_overlap()'))
-        self.db.commit()
+        count = self._call_procedure(session, CALL_OVERLAPPING_PROCEDURE, maximum_overlap=maximum_overlap)
         end = time.time()
-        count = self.db.query(Nest).filter(Nest.discarded == 'overlap').count()
         logging.info(f'Disabled {count} overlapping nests in {human_time(end - start)}.')
 
-    def create_overlapping_procedure(self, maximum_overlap: int) -> None:
+    def create_overlapping_procedure(self) -> None:
         """
         Creates the stored procedure for filtering overlapping nests.
+        """
+        self._create_procedure('nest_filter_overlap', NEST_OVERLAPPING_PROCEDURE)
+
+    def call_procedures(self, minimum_spawnpoints: int, minimum_coverage: Optional[int], maximum_overlap: int) -> None:
+        """
+        Calls the stored procedures for filtering the nests, committing all of them in a single transaction.
+
+        The procedures must be created beforehand, as creating a procedure implicitly commits the transaction.
 
         Args:
+            minimum_spawnpoints (int): The minimum spawnpoints of a nest.
+            minimum_coverage (Optional[int]): The minimum coverage of a nest by mon area, only used with the stats database.
             maximum_overlap (int): The maximum allowed overlap between nests.
         """
-        self.db.execute(text(f'DROP PROCEDURE IF EXISTS nest_filter_overlap'))
-        with open(NEST_OVERLAPPING_PROCEDURE, 'r') as file:
-            procedure = file.read()
-            procedure = procedure.format(maximum_overlap=maximum_overlap)
-        self.db.execute(text(procedure))
+        with self.session_local() as session:
+            self.call_spawnpoints_procedure(session, minimum_spawnpoints)
+            if self.use_stats_db:
+                self.call_low_coverage_procedure(session, minimum_coverage)
+            self.call_overlappping_procedure(session, maximum_overlap)
+            session.commit()
 
     def count_active_nests(self) -> int:
         """
@@ -187,20 +283,33 @@ class Database:
         Returns:
             int: The number of active nests in the database.
         """
-        count = self.db.query(Nest).filter(Nest.active == True).count()
+        with self.session_local() as session:
+            count = session.execute(COUNT_ACTIVE_NESTS_QUERY).scalar()
         return count
 
-    def save_nests(self, nests: List[Nest]) -> None:
+    def save_nests(self, nests: List[dict]) -> None:
         """
-        Saves the nests to the database deleting all previous nests.
+        Saves the nests to the database, updating the ones that already exist.
+
+        Existing nests are never deleted, as their pokemon and discarded columns are
+        maintained by the scripts and would be lost by a DELETE or TRUNCATE.
+
+        The nests are upserted in batches of multi-row INSERT ... ON DUPLICATE KEY UPDATE
+        statements, which avoids both the SELECT per nest done by the ORM merge and the
+        INSERT per row done by PyMySQL when it cannot rewrite an executemany.
 
         Args:
-            nests (List[Nest]): The nests to save.
+            nests (List[dict]): The nests to save, as rows of the nests table.
         """
         logging.info(f'Saving {len(nests)} nests to database...')
         start = time.time()
-        for nest in nests:
-            self.db.merge(nest)
-        self.db.commit()
+        with self.session_local() as session:
+            for i in range(0, len(nests), NEST_INSERT_BATCH_SIZE):
+                statement = insert(Nest.__table__).values(nests[i:i + NEST_INSERT_BATCH_SIZE])
+                statement = statement.on_duplicate_key_update({
+                    column: statement.inserted[column] for column in NEST_COLUMNS if column != 'nest_id'
+                })
+                session.execute(statement)
+            session.commit()
         end = time.time()
         logging.info(f'Saved nests to database in {human_time(end - start)}.')
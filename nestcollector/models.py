@@ -2,11 +2,15 @@
 Module containing model database definitions.
 """
 
+import shapely
+
+from shapely.geometry.base import BaseGeometry
 from sqlalchemy import Column, Float, Index, String, func, text
 from sqlalchemy.types import UserDefinedType
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql.expression import ColumnElement
 from sqlalchemy.dialects.mysql import BIGINT, DECIMAL, INTEGER, SMALLINT, TINYINT
+from typing import Callable, Union
 
 Base = declarative_base()
 
@@ -25,29 +29,61 @@ class Geometry(UserDefinedType):
         """
         return 'GEOMETRY'
 
+    def bind_processor(self, dialect) -> Callable[[Union[BaseGeometry, bytes]], bytes]:
+        """
+        Returns a processor serializing the polygon objects to WKB.
+
+        WKB is about half the size of WKT and cheaper to parse on the server. Polygons
+        already serialized to WKB, as done in bulk by Nest.get_nests, are passed through.
+
+        Args:
+            dialect: The dialect in use.
+
+        Returns:
+            Callable[[Union[BaseGeometry, bytes]], bytes]: The processor serializing a polygon object to WKB.
+        """
+        def process(polygon: Union[BaseGeometry, bytes]) -> bytes:
+            if isinstance(polygon, bytes):
+                return polygon
+            return shapely.to_wkb(polygon)
+        return process
+
     def bind_expression(self, polygon) -> ColumnElement:
         """
-        Given a polygon object, return the WKB representation of the polygon.
+        Given a WKB polygon, return the geometry built from it.
 
         Args:
-            polygon: The polygon object.
+            polygon: The WKB polygon.
 
         Returns:
-            sqlalchemy.sql.expression.ColumnElement: The WKB representation of the polygon.
+            sqlalchemy.sql.expression.ColumnElement: The geometry built from the WKB polygon.
         """
-        return func.ST_GeomFromText(polygon, type_=self)
+        return func.ST_GeomFromWKB(polygon, type_=self)
 
     def column_expression(self, col) -> ColumnElement:
         """
-        Given a SELECT column expression, return the WKT representation of the polygon.
+        Given a SELECT column expression, return the WKB representation of the polygon.
 
         Args:
             col: The column expression.
 
         Returns:
-            sqlalchemy.sql.expression.ColumnElement: The WKT representation of the polygon.
+            sqlalchemy.sql.expression.ColumnElement: The WKB representation of the polygon.
+        """
+        return func.ST_AsBinary(col, type_=self)
+
+    def result_processor(self, dialect, coltype) -> Callable[[bytes], BaseGeometry]:
+        """
+        Returns a processor loading the WKB polygons into polygon objects.
+
+        Args:
+            dialect: The dialect in use.
+            coltype: The DBAPI column type.
+
+        Returns:
+            Callable[[bytes], BaseGeometry]: The processor loading a WKB polygon into a polygon object.
         """
-        return func.ST_AsText(col, type_=self)
+        return shapely.from_wkb
 
 
 class Nest(Base):
@@ -57,6 +93,8 @@ class Nest(Base):
     __tablename__ = 'nests'
     __table_args__ = (
         Index('CoordsIndex', 'lat', 'lon'),
+        Index('UpdatedCoordsIndex', 'updated', 'lat', 'lon'),
+        Index('PolygonIndex', 'polygon', mysql_prefix='SPATIAL'),
     )
 
     nest_id = Column(BIGINT(20), primary_key=True, autoincrement=False)
@@ -70,41 +108,8 @@ class Nest(Base):
     active = Column(TINYINT(1), server_default=text('0'))
     pokemon_id = Column(INTEGER(11))
     pokemon_form = Column(SMALLINT(6))
-    pokemon_avg = Column(Float(asdecimal=True))
-    pokemon_ratio = Column(Float(asdecimal=True), server_default=text('0'))
-    pokemon_count = Column(Float(asdecimal=True), server_default=text('0'))
+    pokemon_avg = Column(Float())
+    pokemon_ratio = Column(Float(), server_default=text('0'))
+    pokemon_count = Column(Float(), server_default=text('0'))
     discarded = Column(String(40))
-    updated = Column(INTEGER(10), index=True)
-
-    def __init__(
-            self,
-            nest_id: int,
-            lat: float,
-            lon: float,
-            name: str,
-            polygon: Geometry,
-            area_name: str,
-            spawnpoints: int,
-            m2: float
-        ) -> None:
-        """
-        Initializes a new nest.
-
-        Args:
-            nest_id (int): The ID of the nest.
-            lat (float): The latitude of the nest.
-            lon (float): The longitude of the nest.
-            name (str): The name of the nest.
-            polygon (Geometry): The polygon of the nest.
-            area_name (str): The name of the area.
-            spawnpoints (int): The number of spawnpoints in the nest.
-            m2 (float): The area of the nest in square meters.
-        """
-        self.nest_id = nest_id
-        self.lat = lat
-        self.lon = lon
-        self.name = name
-        self.polygon = polygon
-        self.area_name = area_name
-        self.spawnpoints = spawnpoints
-        self.m2 = m2
+    updated = Column(INTEGER(10))
@@ -3,39 +3,98 @@ Module for creating the Nest class, which is used to store and processing the da
 """
 
 import logging
+import numpy as np
+import shapely
 import time
 
-from .models import Nest as NestModel
-from .osm_elements import Node, Relation, Way
+from collections import Counter
+from functools import partial
+from itertools import repeat
+from operator import itemgetter
+from shapely.geometry.base import BaseGeometry
+
+from .osm_elements import Relation, Way
 from .timing import human_time
 
-from typing import List, Set, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 # The maximum area in m2 to add a nest into the database (30 km2)
 MAXIMUM_M2 = 30e6
 
+# An upper bound of the length in meters of a degree of latitude or longitude on the WGS84 ellipsoid
+MAXIMUM_DEGREE_M = 111700
+
+
+def maximum_areas(geometries: List[BaseGeometry]) -> np.ndarray:
+    """
+    Computes a cheap upper bound of the geodesic areas in m2 of the geometries, from their bounding boxes.
+
+    Args:
+        geometries (List[BaseGeometry]): The geometries, which may be None.
+
+    Returns:
+        np.ndarray: The upper bounds of the areas in m2, NaN for the missing geometries.
+    """
+    min_lon, min_lat, max_lon, max_lat = shapely.bounds(geometries).T
+    # A degree of longitude is the longest at the latitude of the bounding box closest to the equator
+    lat = np.where((min_lat <= 0) & (max_lat >= 0), 0, np.minimum(np.abs(min_lat), np.abs(max_lat)))
+    return (max_lon - min_lon) * (max_lat - min_lat) * np.cos(np.radians(lat)) * MAXIMUM_DEGREE_M ** 2
+
+
+def signed_areas(coords: np.ndarray, indices: np.ndarray) -> np.ndarray:
+    """
+    Computes the signed planar areas of rings with the shoelace formula, positive for counter-clockwise rings.
+
+    The sign is the one used by shapely's orient, also for self-intersecting rings,
+    where shapely.is_ccw only looks at the vertices around the highest point.
+
+    Examples:
+        >>> bow_tie = [[1, 3], [3, 1], [2, 4], [4, 4]]
+        >>> square = [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+        >>> bool(shapely.is_ccw(shapely.linearrings(bow_tie)))
+        False
+        >>> signed_areas(np.array(bow_tie + square, dtype=np.float64), np.array([0] * 4 + [1] * 5))
+        array([1., 1.])
+
+    Args:
+        coords (np.ndarray): The coordinates of all the rings, which may be closed or not.
+        indices (np.ndarray): The index of the ring of each coordinate, sorted and without gaps.
+
+    Returns:
+        np.ndarray: The signed areas of the rings.
+    """
+    counts = np.bincount(indices)
+    starts = np.cumsum(counts) - counts
+    ends = starts + counts - 1
+    # The previous and next coordinate of each one, wrapping around its ring
+    previous = np.arange(len(indices)) - 1
+    previous[starts] = ends
+    following = np.arange(len(indices)) + 1
+    following[ends] = starts
+    # Relative to the first coordinate of each ring, to reduce the rounding errors
+    relative = coords - coords[starts[indices]]
+    x, y = relative[:, 0], relative[:, 1]
+    return np.bincount(indices, weights=x * (y[following] - y[previous]), minlength=len(counts)) / 2
+
 
 class Nest:
     """
     Class for storing and processing the data from the Overpass API.
 
     Attributes:
-        osm_data (List[dict]): The data from the Overpass API.
-        area_names (List[str]): The names of the areas.
         default_name (str): The default name of the nest.
         minimum_m2 (float): The minimum area in m2 to add a nest into the database.
         buffer_multipolygons (bool): Whether to buffer the multipolygons or not.
-        nodes (Set[Node]): The nodes from the Overpass API data.
-        ways (Set[Way]): The ways from the Overpass API data.
-        relations (Set[Relation]): The relations from the Overpass API data.
-        nodes_dict (Dict[int, Node]): The nodes from the Overpass API data as a dictionary.
-        ways_dict (Dict[int, Way]): The ways from the Overpass API data as a dictionary.
+        node_indices (Dict[int, int]): The index in node_coords of the nodes from the Overpass API data by ID.
+        node_coords (np.ndarray): The (lon, lat) coordinates of the nodes from the Overpass API data.
+        ways_dict (Dict[int, Way]): The ways from the Overpass API data by ID.
+        relations_dict (Dict[int, Relation]): The relations from the Overpass API data by ID.
+        used_way_ids (Set[int]): The IDs of the ways that are members of a relation.
     """
 
     def __init__(
             self,
-            osm_data: List[dict],
-            area_names: List[str],
+            osm_data: Iterable[Tuple[str, dict]],
             default_name: str,
             minimum_m2: float,
             buffer_multipolygons: bool
@@ -44,20 +103,22 @@ class Nest:
         Initializes the Nest class.
 
         Args:
-            osm_data (List[dict]): The data from the Overpass API.
-            area_names (List[str]): The names of the areas.
+            osm_data (Iterable[Tuple[str, dict]]): The names of the areas and their data from the Overpass API.
             default_name (str): The default name of the nest.
             minimum_m2 (float): The minimum area in m2 to add a nest into the database.
             buffer_multipolygons (bool): Whether to buffer the multipolygons or not.
         """
-        self.osm_data = osm_data
-        self.area_names = area_names
         self.default_name = default_name
         self.minimum_m2 = minimum_m2
         self.buffer_multipolygons = buffer_multipolygons
-        self.nodes, self.ways, self.relations = self._get_osm_elements()
-        self.nodes_dict = {node.id: node for node in self.nodes}
-        self.ways_dict = {way.id: way for way in self.ways}
+        # The OSM data is not kept, so the data of each area can be freed once its elements are built
+        self.node_indices, self.node_coords, self.ways_dict, self.relations_dict = self._get_osm_elements(osm_data)
+        self.used_way_ids = {
+            member['ref']
+            for relation in self.relations_dict.values()
+            for member in relation.members
+            if member['type'] == 'way'
+        }
         self._build_polygons()
 
     def _build_polygons(self) -> None:
@@ -66,130 +127,170 @@ class Nest:
         """
         logging.info('Building polygons...')
         start = time.time()
-        for way in self.ways:
-            way.polygon = way.build_polygon(self.nodes_dict)
-        for relation in self.relations:
+        self._build_ways_polygons()
+        for relation in self.relations_dict.values():
             relation.multipolygon = relation.build_multipolygon(self.ways_dict, self.buffer_multipolygons)
         end = time.time()
         logging.info(f'Polygons built in {human_time(end - start)}.')
 
-    def _get_osm_elements(self) -> Tuple[Set[Node], Set[Way], Set[Relation]]:
+    def _build_ways_polygons(self) -> None:
+        """
+        Builds the polygons of all the ways at once.
+
+        The coordinates of every way are gathered into a single array, so the
+        rings and polygons are built by shapely in one call each.
+        """
+        node_indices = self.node_indices
+        ways, nodes, indices = [], [], []
+        for way in self.ways_dict.values():
+            # Remove the nodes of the way that are not in the OSM data
+            way.nodes = [node for node in way.nodes if node in node_indices]
+            # Check if the way has at least 3 nodes
+            if len(way.nodes) < 3:
+                way.polygon = None
+                continue
+            nodes.extend(node_indices[node] for node in way.nodes)
+            indices.extend(repeat(len(ways), len(way.nodes)))
+            ways.append(way)
+        if not ways:
+            return
+        coords, indices = self.node_coords[nodes], np.array(indices)
+        rings = shapely.linearrings(coords, indices=indices)
+        # Orient the rings counter-clockwise to compute the m2 area, by the sign of their area like shapely's orient
+        clockwise = signed_areas(coords, indices) < 0
+        rings[clockwise] = shapely.reverse(rings[clockwise])
+        for way, polygon in zip(ways, shapely.polygons(rings)):
+            way.polygon = polygon
+
+    def _get_osm_elements(self, osm_data: Iterable[Tuple[str, dict]]) -> Tuple[Dict[int, int], np.ndarray, Dict[int, Way], Dict[int, Relation]]:
         """
         Gets the OSM elements from the Overpass API data.
 
+        The elements are deduplicated by ID, as areas can overlap, skipping the
+        construction of the elements already seen. Nodes are only kept as
+        coordinates in a single array, indexed by their ID.
+
+        Args:
+            osm_data (Iterable[Tuple[str, dict]]): The names of the areas and their data from the Overpass API.
+
         Returns:
-            Tuple[Set[Node], Set[Way], Set[Relation]]: The nodes, ways, and relations.
+            Tuple[Dict[int, int], np.ndarray, Dict[int, Way], Dict[int, Relation]]: The node indices by ID, the
+                node coordinates, and the ways and relations by ID.
         """
         logging.info('Processing OSM elements...')
         start = time.time()
-        nodes, ways, relations = set(), set(), set()
-        for area, area_name in zip(self.osm_data, self.area_names):
-            for element in area['elements']:
-                if element['type'] == 'node':
-                    node = Node(**element)
-                    nodes.add(node)
-                elif element['type'] == 'relation':
-                    relation = Relation(**element, default_name=self.default_name, area_name=area_name)
-                    relations.add(relation)
-                elif element['type'] == 'way':
-                    way = Way(**element, default_name=self.default_name, area_name=area_name)
-                    ways.add(way)
+        node_indices, node_coords, ways, relations = {}, [], {}, {}
+        get_type_and_id = itemgetter('type', 'id')
+        for area_name, area in osm_data:
+            # The class building each type of element and the dict storing it
+            dispatch = {
+                'way': (partial(Way, default_name=self.default_name, area_name=area_name), ways),
+                'relation': (partial(Relation, default_name=self.default_name, area_name=area_name), relations)
+            }
+            elements = area['elements']
+            for element in elements:
+                element_type, element_id = get_type_and_id(element)
+                if element_type == 'node':
+                    if element_id not in node_indices:
+                        node_indices[element_id] = len(node_coords)
+                        node_coords.append((element['lon'], element['lat']))
+                    continue
+                element_class, elements_dict = dispatch.get(element_type, (None, None))
+                if element_class is None or element_id in elements_dict:
+                    continue
+                elements_dict[element_id] = element_class(**element)
         end = time.time()
-        logging.info(f'Found {len(nodes)} nodes, {len(ways)} ways, and {len(relations)} relations in {human_time(end - start)}.')
-        return nodes, ways, relations
+        logging.info(f'Found {len(node_indices)} nodes, {len(ways)} ways, and {len(relations)} relations in {human_time(end - start)}.')
+        return node_indices, np.array(node_coords, dtype=np.float64), ways, relations
 
-    def _get_nests_ways(self) -> Tuple[List[NestModel], int, int, int]:
+    def _filter_ways(self, skipped: Counter) -> Iterator[Way]:
         """
-        Gets the nests from the ways.
+        Filters the ways that can be added as nests.
 
-        Returns:
-            Tuple[List[NestModel], int, int, int]: The nests, the number of invalid small and duplicated nests.
+        Args:
+            skipped (Counter): The number of skipped ways by reason, updated in place.
+
+        Yields:
+            Way: The ways that can be added as nests.
         """
-        nests = []
-        invalid_nests = 0
-        small_nests = 0
-        duplicated_nests = 0
-        for way in self.ways:
+        ways = list(self.ways_dict.values())
+        max_areas = maximum_areas([way.polygon for way in ways])
+        for way, max_area in zip(ways, max_areas.tolist()):
             # Skip ways that don't have a polygon
             if way.polygon is None:
-                invalid_nests += 1
+                skipped['invalid'] += 1
                 continue
-            # Skip ways that are too small
-            if way.area < self.minimum_m2:
-                small_nests += 1
+            # Skip ways that are too small, without computing their area if its upper bound already is
+            if max_area < self.minimum_m2 or way.area < self.minimum_m2:
+                skipped['small'] += 1
                 continue
             # Skip ways that are too big
             if way.area > MAXIMUM_M2:
                 continue
             # Skip ways that are duplicated in a relation
-            if way.used_in_relation:
-                duplicated_nests += 1
+            if way.id in self.used_way_ids:
+                skipped['duplicated'] += 1
                 continue
-            nests.append(
-                NestModel(
-                    nest_id=way.id,
-                    lat=way.polygon.centroid.y,
-                    lon=way.polygon.centroid.x,
-                    name=way.name,
-                    polygon=way.polygon,
-                    area_name=way.area_name,
-                    spawnpoints=None,
-                    m2=way.area
-                )
-            )
-        return nests, invalid_nests, small_nests, duplicated_nests
+            yield way
 
-    def _get_nests_relations(self) -> Tuple[List[NestModel], int, int]:
+    def _filter_relations(self, skipped: Counter) -> Iterator[Relation]:
         """
-        Gets the nests from the relations.
+        Filters the relations that can be added as nests.
 
-        Returns:
-            Tuple[List[NestModel], int, int]: The nests, the number of invalid and small nests.
+        Args:
+            skipped (Counter): The number of skipped relations by reason, updated in place.
+
+        Yields:
+            Relation: The relations that can be added as nests.
         """
-        nests = []
-        invalid_nests = 0
-        small_nests = 0
-        for relation in self.relations:
+        relations = list(self.relations_dict.values())
+        max_areas = maximum_areas([relation.multipolygon for relation in relations])
+        for relation, max_area in zip(relations, max_areas.tolist()):
             # Skip relations that don't have a multipolygon
             if relation.multipolygon is None:
-                invalid_nests += 1
+                skipped['invalid'] += 1
                 continue
-            # Skip relations that are too small
-            if relation.area < self.minimum_m2:
-                small_nests += 1
+            # Skip relations that are too small, without computing their area if its upper bound already is
+            if max_area < self.minimum_m2 or relation.area < self.minimum_m2:
+                skipped['small'] += 1
                 continue
             # Skip relations that are too big
             if relation.area > MAXIMUM_M2:
                 continue
-            nests.append(
-                NestModel(
-                    nest_id=relation.id,
-                    lat=relation.multipolygon.centroid.y,
-                    lon=relation.multipolygon.centroid.x,
-                    name=relation.name,
-                    polygon=relation.multipolygon,
-                    area_name=relation.area_name,
-                    spawnpoints=None,
-                    m2=relation.area
-                )
-            )
-        return nests, invalid_nests, small_nests
-    
-    def get_nests(self) -> List[NestModel]:
+            yield relation
+
+    def get_nests(self) -> List[dict]:
         """
         Gets the nests from the OSM elements.
 
         Returns:
-            List[NestModel]: The nests.
+            List[dict]: The nests, as rows of the nests table with the polygons serialized to WKB.
         """
         logging.info(f'Filtering nests...')
         start = time.time()
-        nests_ways, invalid_ways, small_ways, duplicated_ways = self._get_nests_ways()
-        nests_relations, invalid_relations, small_relations = self._get_nests_relations()
-        nests = nests_ways + nests_relations
-        invalid_nests = invalid_ways + invalid_relations
-        small_nests = small_ways + small_relations
+        skipped = Counter()
+        elements = [(way, way.polygon) for way in self._filter_ways(skipped)]
+        elements.extend((relation, relation.multipolygon) for relation in self._filter_relations(skipped))
+        # Compute the centroids and serialize to WKB all the polygons at once
+        polygons = [polygon for _, polygon in elements]
+        centroids = shapely.centroid(polygons)
+        wkbs = shapely.to_wkb(polygons)
+        nests = [
+            {
+                'nest_id': element.id,
+                'lat': lat,
+                'lon': lon,
+                'name': element.name,
+                'polygon': wkb,
+                'area_name': element.area_name,
+                'spawnpoints': None,
+                'm2': element.area
+            }
+            for (element, _), lon, lat, wkb in zip(
+                elements, shapely.get_x(centroids).tolist(), shapely.get_y(centroids).tolist(), wkbs
+            )
+        ]
         end = time.time()
-        logging.info(f'Filtered {invalid_nests} invalid nests, {small_nests} small nests ' \
-                     f'and {duplicated_ways} duplicated nests in {human_time(end - start)}.')
+        logging.info(f'Filtered {skipped["invalid"]} invalid nests, {skipped["small"]} small nests ' \
+                     f'and {skipped["duplicated"]} duplicated nests in {human_time(end - start)}.')
         return nests
@@ -5,67 +5,10 @@ Module containing the OSMElements class, which is used to parse OSM elements fro
 from pyproj import Geod
 from shapely.geometry import MultiPolygon, Polygon
 from shapely.ops import orient
-from typing import List, Mapping, Optional, Union
+from typing import List, Mapping, Optional, Tuple, Union
 
-
-class Node:
-    """
-    Represents an OSM node.
-
-    Attributes:
-        type (str): The type of the element.
-        id (int): The ID of the element.
-        lat (float): The latitude of the node.
-        lon (float): The longitude of the node.
-        tags (Optional[dict]): The tags of the element.
-    """
-
-    def __init__(self, type: str, id: int, lat: float, lon: float, tags: Optional[dict] = None) -> None:
-        """
-        Initializes the Node class.
-
-        Args:
-            type (str): The type of the element.
-            id (int): The ID of the element.
-            lat (float): The latitude of the node.
-            lon (float): The longitude of the node.
-            tags (Optional[dict]): The tags of the element.
-        """
-        self.type = type
-        self.id = id
-        self.lat = lat
-        self.lon = lon
-        self.tags = tags
-
-    def __eq__(self, other: 'Node') -> bool:
-        """
-        Checks if two nodes are equal, by comparing their IDs.
-
-        Args:
-            other (Node): The other node.
-        
-        Returns:
-            bool: True if the nodes are equal, False otherwise.
-        """
-        return isinstance(other, Node) and self.id == other.id
-
-    def __hash__(self) -> int:
-        """
-        Returns the hash of the node.
-
-        Returns:
-            int: The hash of the node.
-        """
-        return hash(self.id)
-
-    def __str__(self) -> str:
-        """
-        Returns a string representation of the node.
-
-        Returns:
-            str: The string representation of the node.
-        """
-        return f'Node(id={self.id}, lat={self.lat}, lon={self.lon}, tags={self.tags})'
+# The WGS84 ellipsoid used to compute the geodesic areas, shared as building it parses PROJ strings
+GEOD = Geod(ellps='WGS84')
 
 
 class Way:
@@ -81,9 +24,10 @@ class Way:
         polygon (Optional[Polygon]): The polygon of the way.
         area (Optional[float]): The area in m2 of the way.
         area_name (Optional[str]): The name of the area the way belongs.
-        used_in_relation (bool): Whether the way is used in a relation.
     """
 
+    __slots__ = ('type', 'id', 'nodes', 'tags', 'name', 'polygon', '_area', 'area_name')
+
     def __init__(
             self,
             type: str,
@@ -112,7 +56,6 @@ class Way:
         self.polygon = None
         self._area = None
         self.area_name = area_name
-        self.used_in_relation = False
 
     @property
     def area(self) -> float:
@@ -125,16 +68,15 @@ class Way:
         if self.polygon is None:
             self.polygon = self.build_polygon()
         if self._area is None:
-            geod = Geod(ellps='WGS84')
-            self._area = geod.geometry_area_perimeter(self.polygon)[0]
+            self._area = GEOD.geometry_area_perimeter(self.polygon)[0]
         return self._area
 
-    def build_polygon(self, nodes: Mapping[int, Node]) -> Polygon:
+    def build_polygon(self, nodes: Mapping[int, Tuple[float, float]]) -> Polygon:
         """
         Builds a polygon from the way's nodes.
 
         Args:
-            nodes (Mapping[int, Node]): The nodes of the way.
+            nodes (Mapping[int, Tuple[float, float]]): The (lon, lat) coordinates of the nodes by ID.
 
         Returns:
             Polygon: The polygon of the way.
@@ -145,7 +87,7 @@ class Way:
         # Check if the way has at least 3 nodes
         if len(self.nodes) < 3:
             return None
-        polygon = Polygon([(nodes[node].lon, nodes[node].lat) for node in self.nodes])
+        polygon = Polygon([nodes[node] for node in self.nodes])
         polygon = orient(polygon) # Orient the polygon to compute the m2 area
         return polygon
 
@@ -159,7 +101,7 @@ class Way:
         Returns:
             bool: True if the ways are equal, False otherwise.
         """
-        return isinstance(other, Way) and self.id == other.id
+        return self.__class__ is other.__class__ and self.id == other.id
 
     def __hash__(self) -> int:
         """
@@ -168,7 +110,7 @@ class Way:
         Returns:
             int: The hash of the way.
         """
-        return hash(self.id)
+        return self.id
 
     def __str__(self) -> str:
         """
@@ -195,6 +137,8 @@ class Relation:
         area_name (Optional[str]): The name of the area the relation belongs.
     """
 
+    __slots__ = ('type', 'id', 'members', 'tags', 'name', 'multipolygon', '_area', 'area_name')
+
     def __init__(
             self,
             type: str,
@@ -235,8 +179,7 @@ class Relation:
         if self.multipolygon is None:
             self.multipolygon = self.build_multipolygon()
         if self._area is None:
-            geod = Geod(ellps='WGS84')
-            self._area = geod.geometry_area_perimeter(self.multipolygon)[0]
+            self._area = GEOD.geometry_area_perimeter(self.multipolygon)[0]
         return self._area
 
     def build_multipolygon(self, ways: Mapping[int, Way], buffer: bool = False) -> Union[MultiPolygon, Polygon]:
@@ -252,7 +195,7 @@ class Relation:
             buffer (Optional[bool]): Whether to buffer the multipolygon or not. Defaults to False.
 
         Returns:
-            MultiPolygon: The multipolygon of the relation.
+            Union[MultiPolygon, Polygon]: The multipolygon of the relation, or its polygon if it has a single one.
         """
         # NOTE: Perimeter ways must be ignored according to the OSM wiki
         polygons = {'outer': [], '': [], 'inner': []}
@@ -262,13 +205,9 @@ class Relation:
                 # Check if the way is in the ways dict
                 if not way:
                     continue
-                way.used_in_relation = True
+                # Check if the way is a polygon, as all of them are built beforehand
                 if way.polygon is None:
-                    polygon = way.build_polygon(ways)
-                    # Check if the way is a polygon
-                    if polygon is None:
-                        continue
-                    way.polygon = polygon
+                    continue
                 # Add the polygon to the corresponding list of polygons
                 if member['role'] in polygons:
                     polygons[member['role']].append(way.polygon)
@@ -283,7 +222,8 @@ class Relation:
         else:
             return None
 
-        multipolygon = MultiPolygon(polygons)
+        # A single polygon is kept as is, as wrapping it would only add a GEOS allocation
+        multipolygon = polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
         if buffer:
             multipolygon = multipolygon.buffer(1e-4) # As OSM data is not perfect, we need to buffer the multipolygon
         multipolygon = orient(multipolygon) # Orient the multipolygon to compute the m2 area
@@ -296,7 +236,7 @@ class Relation:
         Args:
             other (Relation): The other relation.
         """
-        return isinstance(other, Relation) and self.id == other.id
+        return self.__class__ is other.__class__ and self.id == other.id
 
     def __hash__(self) -> int:
         """
@@ -305,7 +245,7 @@ class Relation:
         Returns:
             int: The hash of the relation.
         """
-        return hash(self.id)
+        return self.id
 
     def __str__(self) -> str:
         """
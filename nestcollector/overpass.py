@@ -2,16 +2,75 @@
 Module containing the Overpass class, which is used to query the OpenStreetMap data.
 """
 
+import contextlib
+import hashlib
 import logging
 import json
+import numpy as np
+import orjson
 import os
+import random
 import requests
 import time
+import zstandard as zstd
 
 from .timing import human_time
 
-from shapely import geometry
-from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from typing import Iterator, List, Tuple
+from urllib3.util.retry import Retry
+
+# The logger of the module, formatting the messages only if they are emitted
+logger = logging.getLogger(__name__)
+
+# The folder of the cached OpenStreetMap data, next to the package so it is found whatever the working directory
+DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+# The zstd compression level of the cached OpenStreetMap data
+ZSTD_LEVEL = 3
+
+# The size in bytes of the chunks streamed from the responses to the data folder
+CHUNK_SIZE = 1 << 20
+
+# The connect and read timeouts of the requests in seconds, the read one matching the timeout of the query
+REQUEST_TIMEOUT = (10, 100000)
+
+# The times to retry a transient error on the same endpoint, read errors are not retried as the queries are slow
+ENDPOINT_RETRIES = 3
+
+# The HTTP statuses of the transient errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# The seconds to wait after all the endpoints failed for the first time, doubled on each retry
+BACKOFF_BASE = 5
+
+# The maximum seconds to wait after all the endpoints failed
+MAXIMUM_BACKOFF = 300
+
+# The maximum times to retry all the endpoints before giving up
+MAXIMUM_RETRIES = 8
+
+# The Overpass query for the possible nests in a bounding box at a given date
+OVERPASS_QUERY = """
+[out:json]
+[date:"{date}"]
+[timeout:100000]
+[bbox:{bbox}];
+(
+    way["landuse"~"farmland|farmyard|grass|greenfield|meadow|orchard|recreation_ground|vineyard"];
+    way["leisure"~"garden|golf_course|nature_reserve|park|pitch|playground|recreation_ground"];
+    way["natural"~"grassland|heath|moor|plateau|scrub"];
+
+    rel["landuse"~"farmland|farmyard|grass|greenfield|meadow|orchard|recreation_ground|vineyard"];
+    rel["leisure"~"garden|golf_course|nature_reserve|park|pitch|playground|recreation_ground"];
+    rel["natural"~"grassland|heath|moor|plateau|scrub"];
+);
+out body;
+>;
+out skel qt;
+"""
 
 
 class Overpass:
@@ -19,10 +78,10 @@ class Overpass:
     Class for querying the OpenStreetMap data using the Overpass API.
 
     Attributes:
-        url (str): The URL of the Overpass API.
+        endpoints (List[str]): The Overpass API endpoints, in order of priority.
         area_names (List[str]): The names of the areas.
-        polygons (List[shapely.geometry.Polygon]): The polygons to query.
         bboxes (List[str]): The bounding boxes to query.
+        sessions (Dict[str, requests.Session]): The HTTP sessions, one per endpoint, created on the first query.
     """
 
     def __init__(self, endpoints: List[str], areas_path: str) -> None:
@@ -30,146 +89,291 @@ class Overpass:
         Initializes the Overpass class.
 
         Args:
+            endpoints (List[str]): The Overpass API endpoints, in order of priority.
             areas_path (str): The path to the areas GeoJSON file.
         """
         self.endpoints = endpoints
-        self.endpoint_idx = 0
-        self.area_names = self._get_names(areas_path)
-        self.polygons = self._load_polygons(areas_path)
-        self.bboxes = self._get_bboxes()
+        with open(areas_path, 'r') as f:
+            areas = json.load(f)
+        self.area_names = self._get_names(areas)
+        self.bboxes = self._get_bboxes(areas)
+        # The sessions are only created when an area has to be queried
+        self.sessions = {}
 
-    def _get_names(self, areas_path: str) -> List[str]:
+    def __del__(self) -> None:
+        """
+        Closes the HTTP sessions.
+        """
+        for session in getattr(self, 'sessions', {}).values():
+            session.close()
+
+    def _create_session(self) -> requests.Session:
+        """
+        Creates an HTTP session for an endpoint.
+
+        Every worker can end up querying the same endpoint when the others fail,
+        so the session keeps up to one connection per worker. Transient errors are
+        retried on the same endpoint first, honoring the Retry-After header, and the
+        last response is returned so the query can move to the next endpoint.
+
+        Returns:
+            requests.Session: The HTTP session.
+        """
+        session = requests.Session()
+        retry = Retry(
+            total=ENDPOINT_RETRIES,
+            read=0,
+            backoff_factor=1,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({'POST'}),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(self.endpoints), max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _get_names(self, areas: List[dict]) -> List[str]:
         """
         Gets the names of the areas from the areas GeoJSON file.
 
         Args:
-            areas_path (str): The path to the areas GeoJSON file.
+            areas (List[dict]): The areas from the areas GeoJSON file.
 
         Returns:
             List[str]: The names of the areas.
         """
-        with open(areas_path, 'r') as f:
-            areas = json.load(f)
         return [area['name'] for area in areas]
 
-    def _load_polygons(self, areas_path: str) -> List[geometry.Polygon]:
+    def _get_bboxes(self, areas: List[dict]) -> List[str]:
         """
-        Loads the polygon from the areas GeoJSON file.
+        Gets the bounding boxes of the areas directly from their paths.
 
         Args:
-            areas_path (str): The path to the areas GeoJSON file.
+            areas (List[dict]): The areas from the areas GeoJSON file.
 
         Returns:
-            List[shapely.geometry.Polygon]: The polygons to query.
+            List[str]: The bounding boxes to query.
         """
-        with open(areas_path, 'r') as f:
-            areas = json.load(f)
-
-        polygons = []
+        bboxes = []
         for area in areas:
-            coords = []
-            for lat, lon in area['path']:
-                coords.append((lat, lon))
-            polygons.append(geometry.Polygon(coords))
-        return polygons
+            path = np.asarray(area['path'], dtype=np.float64)
+            (minx, miny), (maxx, maxy) = path.min(axis=0).tolist(), path.max(axis=0).tolist()
+            bboxes.append(f'{minx}, {miny}, {maxx}, {maxy}')
+        return bboxes
 
-    def _get_bboxes(self) -> List[str]:
+    def _get_data_path(self, name: str, query: str) -> str:
         """
-        Gets the bounding boxes for the polygons.
+        Gets the path of the cached OpenStreetMap data of an area.
+
+        The path includes a digest of the query, so changing the bounding box or the date
+        of an area queries its data again instead of reusing stale data. Uncompressed data
+        cached for the same query, or cached by previous versions without a digest, is
+        compressed and reused, as those versions used the same bounding boxes and date.
+
+        Args:
+            name (str): The name of the area.
+            query (str): The Overpass query of the area.
+
         Returns:
-            List[str]: The bounding boxes to query.
+            str: The path of the cached OpenStreetMap data.
         """
-        bboxes = []
-        for polygon in self.polygons:
-            minx, miny, maxx, maxy = polygon.bounds
-            bboxes.append(f'{minx}, {miny}, {maxx}, {maxy}')
-        return bboxes
+        digest = hashlib.sha256(query.encode()).hexdigest()[:16]
+        path = os.path.join(DATA_PATH, f'{name}.{digest}.json.zst')
+        if os.path.exists(path):
+            return path
+
+        for uncompressed_path in (os.path.join(DATA_PATH, f'{name}.{digest}.json'), os.path.join(DATA_PATH, f'{name}.json')):
+            if os.path.exists(uncompressed_path):
+                logger.info('Compressing OpenStreetMap data for %s from %s to %s.', name, uncompressed_path, path)
+                with open(uncompressed_path, 'rb') as f:
+                    content = f.read()
+                with open(path, 'wb') as f:
+                    f.write(zstd.ZstdCompressor(level=ZSTD_LEVEL).compress(content))
+                os.remove(uncompressed_path)
+                break
+        return path
 
-    def _query_osm_data(self, bbox: str, date: str = '2019-02-24T00:00:00Z') -> dict:
+    def _get_retry_after(self, response: requests.Response) -> float:
         """
-        Queries the OpenStreetMap data for the given date and bounding box.
+        Gets the seconds to wait before retrying from the Retry-After header of a response.
 
         Args:
-            bbox (str): The bounding box to query.
-            date (str, optional): The date to query. Defaults to '2019-02-24T00:00:00Z'.
+            response (requests.Response): The response from the Overpass API.
 
         Returns:
-            dict: The response from the Overpass API.
-        """
-        query = """
-        [out:json]
-        [date:"{date}"]
-        [timeout:100000]
-        [bbox:{bbox}];
-        (
-            way["landuse"~"farmland|farmyard|grass|greenfield|meadow|orchard|recreation_ground|vineyard"];
-            way["leisure"~"garden|golf_course|nature_reserve|park|pitch|playground|recreation_ground"];
-            way["natural"~"grassland|heath|moor|plateau|scrub"];
-
-            rel["landuse"~"farmland|farmyard|grass|greenfield|meadow|orchard|recreation_ground|vineyard"];
-            rel["leisure"~"garden|golf_course|nature_reserve|park|pitch|playground|recreation_ground"];
-            rel["natural"~"grassland|heath|moor|plateau|scrub"];
-        );
-        out body;
-        >;
-        out skel qt;
-        """
-        query = query.format(date=date, bbox=bbox)
-        valid_response = False
-        osm_data = None
+            float: The seconds to wait, 0 if the header is missing or invalid.
+        """
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return 0.0
+        # The header is either a number of seconds or an HTTP date
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0.0
+
+    def _save_response(self, response: requests.Response, path: str) -> None:
+        """
+        Streams the body of a response to a file, compressed with zstd.
+
+        The body is written to a temporary file that is renamed once complete,
+        so an interrupted download never leaves partial data in the cache.
+
+        Args:
+            response (requests.Response): The streamed response from the Overpass API.
+            path (str): The path of the cached OpenStreetMap data.
+        """
+        tmp_path = f'{path}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                with zstd.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f, closefd=False) as writer:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        writer.write(chunk)
+        except BaseException:
+            # The temporary file doesn't exist if opening it failed
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+
+    def _query_osm_data(self, query: str, path: str, endpoint_idx: int = 0) -> None:
+        """
+        Queries the OpenStreetMap data using the given Overpass query and saves it.
+
+        Args:
+            query (str): The Overpass query.
+            path (str): The path of the cached OpenStreetMap data.
+            endpoint_idx (int, optional): The index of the first endpoint to query. Defaults to 0.
+
+        Raises:
+            RuntimeError: If the query is invalid or all the endpoints keep failing.
+        """
+        first_endpoint_idx = endpoint_idx
+        cycle = 0
+        retry_after = 0.0
         # Retry if the response is invalid
-        while not valid_response:
-            response = requests.post(self.endpoints[self.endpoint_idx], data=query)
-            if response.status_code == 200 and response.headers['Content-Type'] == 'application/json':
-                valid_response = True
-                osm_data = response.json()
-            else:
-                logging.warning(f'Invalid response from server: {response.status_code} - {response.headers["Content-Type"]}. Moving to the next endpoint...')
-                self.endpoint_idx = (self.endpoint_idx + 1) % len(self.endpoints)
-                if self.endpoint_idx % len(self.endpoints) == 0:
-                    logging.error('All endpoints are down. Waiting 30 seconds before retrying...')
-                    time.sleep(30)
-        return osm_data
+        while True:
+            endpoint = self.endpoints[endpoint_idx]
+            try:
+                with self.sessions[endpoint].post(endpoint, data=query, timeout=REQUEST_TIMEOUT, stream=True) as response:
+                    if response.status_code == 200 and response.headers.get('Content-Type') == 'application/json':
+                        self._save_response(response, path)
+                        return
+                    if response.status_code == 400:
+                        # The query was rejected, so every endpoint would reject it too
+                        raise RuntimeError(f'Invalid Overpass query: {response.status_code} - {response.text[:200]}')
+                    logger.warning('Invalid response from server: %s - %s. Moving to the next endpoint...', response.status_code, response.headers.get('Content-Type'))
+                    retry_after = max(retry_after, self._get_retry_after(response))
+            except requests.RequestException as e:
+                logger.warning('Request to %s failed: %s. Moving to the next endpoint...', endpoint, e)
+            endpoint_idx = (endpoint_idx + 1) % len(self.endpoints)
+            if endpoint_idx == first_endpoint_idx:
+                if cycle == MAXIMUM_RETRIES:
+                    raise RuntimeError(f'All endpoints are down after {MAXIMUM_RETRIES} retries.')
+                # Back off exponentially with full jitter, so concurrent queries don't retry in lockstep,
+                # unless an endpoint asked to wait longer
+                delay = max(retry_after, random.uniform(0, min(MAXIMUM_BACKOFF, BACKOFF_BASE * 2 ** cycle)))
+                logger.error('All endpoints are down. Waiting %.1f seconds before retrying...', delay)
+                time.sleep(delay)
+                cycle += 1
+                retry_after = 0.0
 
-    def get_osm_data(self, date: str = '2019-02-24T00:00:00Z') -> List[dict]:
+    def _query_area(self, name: str, query: str, path: str, endpoint_idx: int) -> None:
+        """
+        Queries and saves the OpenStreetMap data of an area, logging the time it took.
+
+        Args:
+            name (str): The name of the area.
+            query (str): The Overpass query of the area.
+            path (str): The path of the cached OpenStreetMap data.
+            endpoint_idx (int): The index of the first endpoint to query.
+        """
+        logger.info('Querying OpenStreetMap data for %s (this will take ages)...', name)
+        start = time.time()
+        self._query_osm_data(query, path, endpoint_idx)
+        end = time.time()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Finished querying OpenStreetMap data for %s in %s.', name, human_time(end - start))
+
+    def _query_areas(self, queries: List[Tuple[str, str, str]]) -> None:
+        """
+        Queries and saves the OpenStreetMap data of the given areas.
+
+        Args:
+            queries (List[Tuple[str, str, str]]): The name, Overpass query and data path of each area.
+        """
+        # Reuse the connections to each endpoint instead of opening a new one per query
+        if not self.sessions:
+            self.sessions = {endpoint: self._create_session() for endpoint in self.endpoints}
+
+        # Query the OpenStreetMap data of the areas concurrently, one worker per endpoint
+        # Each area starts on a different endpoint and moves to the next ones if it fails
+        # The responses are streamed to the data folder, so they are never held in memory
+        executor = ThreadPoolExecutor(max_workers=len(self.endpoints))
+        futures = [
+            executor.submit(self._query_area, name, query, path, j % len(self.endpoints))
+            for j, (name, query, path) in enumerate(queries)
+        ]
+        # Raise the error of the first failed query without waiting for the rest, cancelling the ones not started
+        # The queries in progress can't be interrupted, they still finish and are saved before the process exits
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+    def get_osm_data(self, date: str = '2019-02-24T00:00:00Z') -> Iterator[Tuple[str, dict]]:
         """
         Gets the OpenStreetMap data for the given date and polygon coords and saves it in the data folder.
 
+        The missing areas are queried and saved first. The data of the areas is then loaded
+        and yielded one at a time, so only a single area is kept in memory.
+
         Args:
             date (str, optional): The date to query. Defaults to '2019-02-24T00:00:00Z'.
 
-        Returns:
-            List[dict]: The OpenStreetMap data.
+        Yields:
+            Tuple[str, dict]: The name of the area and its OpenStreetMap data.
         """
         # Log the start of the process
-        logging.info('Getting OpenStreetMap data...')
+        logger.info('Getting OpenStreetMap data...')
         start = time.time()
 
         # Create the data folder if it doesn't exist
-        os.makedirs('data', exist_ok=True)
+        os.makedirs(DATA_PATH, exist_ok=True)
 
-        # Query the OpenStreetMap data for each polygon coords
-        osm_data = []
+        # Collect the paths of the OpenStreetMap data, and the areas to query
+        paths = []
+        queries = []
         for name, coords in zip(self.area_names, self.bboxes):
-            # Skip if the data already exists
-            if os.path.exists(f'data/{name}.json'):
-                logging.info(f'OpenStreetMap data for {name} already exists.')
-                with open(f'data/{name}.json', 'r') as f:
-                    osm_data.append(json.load(f))
-                continue
-            
-            # Query the OpenStreetMap data
-            logging.info(f'Querying OpenStreetMap data for {name} (this will take ages)...')
-            _start = time.time()
-            _osm_data = self._query_osm_data(coords, date)
-            osm_data.append(_osm_data)
-            with open(f'data/{name}.json', 'w') as f:
-                json.dump(_osm_data, f)
-            _end = time.time()
-            logging.info(f'Finished querying OpenStreetMap data for {name} in {human_time(_end - _start)}.')
-        
+            query = OVERPASS_QUERY.format(date=date, bbox=coords)
+            path = self._get_data_path(name, query)
+            paths.append(path)
+            if os.path.exists(path):
+                logger.info('OpenStreetMap data for %s already exists.', name)
+            else:
+                queries.append((name, query, path))
+
+        # Only areas missing from the data folder are queried, so no endpoint is needed when all of them exist
+        if queries:
+            self._query_areas(queries)
+
         # Log the end of the process
         end = time.time()
-        logging.info(f'Finished getting OpenStreetMap data in {human_time(end - start)}.')
-        
-        return osm_data
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Finished getting OpenStreetMap data in %s.', human_time(end - start))
+
+        # Load the OpenStreetMap data of the areas one at a time
+        # Streamed files don't store their decompressed size, so they are read through a stream reader
+        decompressor = zstd.ZstdDecompressor()
+        for name, path in zip(self.area_names, paths):
+            with open(path, 'rb') as f, decompressor.stream_reader(f) as reader:
+                yield name, orjson.loads(reader.read())
@@ -2,22 +2,34 @@
 Module containing the human_time function, which is used to convert seconds to a human-readable time.
 """
 
-from collections import OrderedDict
+from bisect import bisect_right
 from typing import Union
 
-# The intervals in seconds
-INTERVALS = OrderedDict([
-    ('millennium', 31536000000),  # 60 * 60 * 24 * 365 * 1000
-    ('century', 3153600000),      # 60 * 60 * 24 * 365 * 100
-    ('year', 31536000),           # 60 * 60 * 24 * 365
-    ('month', 2627424),           # 60 * 60 * 24 * 30.41 (assuming 30.41 days in a month)
-    ('week', 604800),             # 60 * 60 * 24 * 7
-    ('day', 86400),               # 60 * 60 * 24
-    ('hour', 3600),               # 60 * 60
-    ('minute', 60),
-    ('second', 1)
-])
+# The intervals in seconds, in ascending order so they can be searched with bisect
+INTERVAL_SECONDS = (
+    1,
+    60,
+    3600,          # 60 * 60
+    86400,         # 60 * 60 * 24
+    604800,        # 60 * 60 * 24 * 7
+    2627424,       # 60 * 60 * 24 * 30.41 (assuming 30.41 days in a month)
+    31536000,      # 60 * 60 * 24 * 365
+    3153600000,    # 60 * 60 * 24 * 365 * 100
+    31536000000    # 60 * 60 * 24 * 365 * 1000
+)
 
+# The singular and plural names of the intervals, in the same order
+INTERVAL_NAMES = (
+    ('second', 'seconds'),
+    ('minute', 'minutes'),
+    ('hour', 'hours'),
+    ('day', 'days'),
+    ('week', 'weeks'),
+    ('month', 'months'),
+    ('year', 'years'),
+    ('century', 'centuries'),
+    ('millennium', 'millennia')
+)
 
 def human_time(seconds: Union[int, float], decimals: int = 2) -> str:
     """
@@ -59,27 +71,14 @@ def human_time(seconds: Union[int, float], decimals: int = 2) -> str:
         # Return in milliseconds
         ms = int(seconds * 1000)
         return '%i millisecond%s' % (ms, 's' if ms != 1 else '')
-    elif 1 < seconds < INTERVALS['minute']:
+    elif 1 < seconds < INTERVAL_SECONDS[1]:
         return str(seconds if input_is_int else round(seconds, decimals)) + ' seconds'
 
+    # Only shows the 2 most important intervals, picking each one with a binary search
     res = []
-    for interval, count in INTERVALS.items():
-        quotient, remainder = divmod(seconds, count)
-        if quotient >= 1:
-            seconds = remainder
-            if quotient > 1:
-                # Plurals
-                if interval == 'millennium':
-                    interval = 'millennia'
-                elif interval == 'century':
-                    interval = 'centuries'
-                else:
-                    interval += 's'
-            res.append('%i %s' % (int(quotient), interval))
-        if remainder == 0:
-            break
+    while len(res) < 2 and seconds >= 1:
+        idx = bisect_right(INTERVAL_SECONDS, seconds) - 1
+        quotient, seconds = divmod(seconds, INTERVAL_SECONDS[idx])
+        res.append('%i %s' % (int(quotient), INTERVAL_NAMES[idx][quotient > 1]))
 
-    if len(res) >= 2:
-        # Only shows 2 most important intervals
-        return '{} and {}'.format(res[0], res[1])
-    return res[0]
+    return ' and '.join(res)
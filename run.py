@@ -6,19 +6,22 @@ import configparser
 import json
 import logging
 import os
+import stat
 import sys
 
-from nestcollector.nest import Nest
-from nestcollector.database import Database
-from nestcollector.overpass import Overpass
+from typing import List, Tuple
 
-from typing import List
+# The folder of the script, so the config is found whatever the working directory
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 
-CONFIG_PATH = 'config/config.ini'
-CONFIG_EXAMPLE_PATH = 'config/config.ini.example'
+CONFIG_PATH = os.path.join(BASE_PATH, 'config', 'config.ini')
+CONFIG_EXAMPLE_PATH = os.path.join(BASE_PATH, 'config', 'config.ini.example')
 
-CONFIG_AREAS_PATH = 'config/areas.json'
-CONFIG_AREAS_EXAMPLE_PATH = 'config/areas.json.example'
+CONFIG_AREAS_PATH = os.path.join(BASE_PATH, 'config', 'areas.json')
+CONFIG_AREAS_EXAMPLE_PATH = os.path.join(BASE_PATH, 'config', 'areas.json.example')
+
+# The logger of the script, configured only when it is run
+logger = logging.getLogger(__name__)
 
 
 class NestCollector:
@@ -35,19 +38,22 @@ class NestCollector:
         """
         Initializes the NestCollector class.
         """
-        # Set the logging level
-        logging.basicConfig(level = logging.INFO)
-
-        # Check that the config file exists
-        if not os.path.isfile(CONFIG_PATH):
-            logging.error(f'Missing {CONFIG_PATH} file, please copy {CONFIG_EXAMPLE_PATH} and fill it with your database settings!')
+        # Check that the config file and the config areas file exist, reporting all the missing ones at once
+        config_exists = self._check_file(
+            CONFIG_PATH,
+            ('Missing %s file, please copy %s and fill it with your database settings!', CONFIG_PATH, CONFIG_EXAMPLE_PATH)
+        )
+        areas_exists = self._check_file(
+            CONFIG_AREAS_PATH,
+            ("Missing %s file, please use 'https://fence.mcore-services.be' to create the geofence!", CONFIG_AREAS_PATH),
+            ('Example areas file: %s', CONFIG_AREAS_EXAMPLE_PATH)
+        )
+        if not (config_exists and areas_exists):
             sys.exit(1)
 
-        # Check that the config areas file exists
-        if not os.path.isfile(CONFIG_AREAS_PATH):
-            logging.error(f"Missing {CONFIG_AREAS_PATH} file, please use 'https://fence.mcore-services.be' to create the geofence!")
-            logging.error(f'Example areas file: {CONFIG_AREAS_EXAMPLE_PATH}')
-            sys.exit(1)
+        # Import the heavy dependencies only once the config is known to exist, so a missing file fails fast
+        from nestcollector.database import Database
+        from nestcollector.overpass import Overpass
 
         # Config
         self.config = configparser.ConfigParser()
@@ -63,25 +69,40 @@ class NestCollector:
             name=self.get_db_name(),
             user=self.get_db_user(),
             password=self.get_db_password(),
+            driver=self.get_db_driver(),
             use_stats_db=self.get_stats_use_stats_db(),
-            stats_host=self.get_stats_db_host(),
-            stats_port=self.get_stats_db_port(),
-            stats_name=self.get_stats_db_name(),
-            stats_user=self.get_stats_db_user(),
-            stats_password=self.get_stats_db_password()
+            stats_name=self.get_stats_db_name()
         )
 
+    def _check_file(self, path: str, *errors: Tuple[str, ...]) -> bool:
+        """
+        Checks that the given path is a regular file, logging the given errors if it is not.
+
+        Args:
+            path (str): The path of the required file.
+            *errors (Tuple[str, ...]): The errors to log if the file is missing, as a format string and its arguments.
+
+        Returns:
+            bool: Whether the file exists.
+        """
+        try:
+            if stat.S_ISREG(os.stat(path).st_mode):
+                return True
+        except OSError:
+            pass
+        for error in errors:
+            logger.error(*error)
+        return False
+
     def run(self) -> None:
         """
         Runs the NestCollector.
         """
-        # Get the OSM data
-        osm_data = self.overpass.get_osm_data()
+        from nestcollector.nest import Nest
 
-        # Get the nests
+        # Get the nests, streaming the OSM data of the areas so each one can be freed once parsed
         nest = Nest(
-            osm_data=osm_data,
-            area_names=self.overpass.area_names,
+            osm_data=self.overpass.get_osm_data(),
             default_name=self.get_default_name(),
             minimum_m2=self.get_minimum_m2(),
             buffer_multipolygons=self.get_buffer_multipolygons()
@@ -92,23 +113,23 @@ class NestCollector:
         previous_active_nests = self.db.count_active_nests()
         self.db.save_nests(nests)
 
-        # Calculate the spawnpoints of the nests
-        self.db.create_spawnpoints_procedure(self.get_minimum_spawnpoints())
-        self.db.call_spawnpoints_procedure()
-
-        # Filter low coverage nests by mon area
-        if self.get_stats_use_stats_db():
-            self.db.create_low_coverage_procedure(self.get_stats_minimum_coverage())
-            self.db.call_low_coverage_procedure()
-
-        # Filter overlapping nests
-        self.db.create_overlapping_procedure(self.get_maximum_overlap())
-        self.db.call_overlappping_procedure()
+        # Create the stored procedures for filtering the nests
+        self.db.create_spawnpoints_procedure()
+        if self.db.use_stats_db:
+            self.db.create_low_coverage_procedure()
+        self.db.create_overlapping_procedure()
+
+        # Calculate the spawnpoints of the nests and filter the low coverage and overlapping ones
+        self.db.call_procedures(
+            minimum_spawnpoints=self.get_minimum_spawnpoints(),
+            minimum_coverage=self.get_stats_minimum_coverage() if self.db.use_stats_db else None,
+            maximum_overlap=self.get_maximum_overlap()
+        )
 
         # Count the final active nests
         final_active_nests = self.db.count_active_nests()
         new_nests = final_active_nests - previous_active_nests
-        logging.info(f'Final active nests: {final_active_nests} ({new_nests} new nests)')
+        logger.info('Final active nests: %s (%s new nests)', final_active_nests, new_nests)
 
     def get_default_name(self) -> str:
         """
@@ -126,7 +147,7 @@ class NestCollector:
         Returns:
             int: The minimum spawnpoints of a nest.
         """
-        return int(self.config['NESTS']['MINIMUM_SPAWNPOINTS'])
+        return self.config.getint('NESTS', 'MINIMUM_SPAWNPOINTS')
 
     def get_minimum_m2(self) -> float:
         """
@@ -135,7 +156,7 @@ class NestCollector:
         Returns:
             float: The minimum m2 of a nest.
         """
-        return float(self.config['NESTS']['MINIMUM_M2'])
+        return self.config.getfloat('NESTS', 'MINIMUM_M2')
     
     def get_maximum_overlap(self) -> int:
         """
@@ -144,7 +165,7 @@ class NestCollector:
         Returns:
             int: The maximum allowed overlap between nests.
         """
-        return int(self.config['NESTS']['MAXIMUM_OVERLAP'])
+        return self.config.getint('NESTS', 'MAXIMUM_OVERLAP')
     
     def get_buffer_multipolygons(self) -> bool:
         """
@@ -153,7 +174,7 @@ class NestCollector:
         Returns:
             bool: Whether to buffer multipolygons.
         """
-        return self.config['NESTS']['BUFFER_MULTIPOLYGONS'].capitalize() == 'True'
+        return self.config.getboolean('NESTS', 'BUFFER_MULTIPOLYGONS')
     
     def get_overpass_endpoints(self) -> List[str]:
         """
@@ -209,6 +230,15 @@ class NestCollector:
         """
         return self.config['DB']['PASSWORD']
 
+    def get_db_driver(self) -> str:
+        """
+        Returns the database driver, defaults to pymysql.
+
+        Returns:
+            str: The database driver.
+        """
+        return self.config['DB'].get('DRIVER', 'pymysql')
+
     def get_stats_use_stats_db(self) -> bool:
         """
         Returns if Stats should be used.
@@ -216,7 +246,7 @@ class NestCollector:
         Returns:
             bool: If Stats should be used.
         """
-        return self.config['STATS']['USE_STATS_DB'].capitalize() == 'True'
+        return self.config.getboolean('STATS', 'USE_STATS_DB')
     
     def get_stats_minimum_coverage(self) -> int:
         """
@@ -225,25 +255,7 @@ class NestCollector:
         Returns:
             int: The minimum coverage of a nest.
         """
-        return int(self.config['STATS']['MINIMUM_COVERAGE'])
-
-    def get_stats_db_host(self) -> str:
-        """
-        Returns the IP host of the Stats db.
-
-        Returns:
-            str: The IP host of the Stats db.
-        """
-        return self.config['STATS']['HOST']
-    
-    def get_stats_db_port(self) -> str:
-        """
-        Returns the port of the Stats db.
-
-        Returns:
-            str: The port of the Stats db.
-        """
-        return self.config['STATS']['PORT']
+        return self.config.getint('STATS', 'MINIMUM_COVERAGE')
 
     def get_stats_db_name(self) -> str:
         """
@@ -253,26 +265,11 @@ class NestCollector:
             str: The Stats database name.
         """
         return self.config['STATS']['NAME']
-    
-    def get_stats_db_user(self) -> str:
-        """
-        Returns the Stats database username.
-
-        Returns:
-            str: The Stats database username.
-        """
-        return self.config['STATS']['USER']
-    
-    def get_stats_db_password(self) -> str:
-        """
-        Returns the Stats database username password.
-
-        Returns:
-            str: The Stats database username password.
-        """
-        return self.config['STATS']['PASSWORD']
 
 
 if __name__ == '__main__':
+    # Set the logging level
+    logging.basicConfig(level = logging.INFO)
+
     nest_collector = NestCollector()
     nest_collector.run()
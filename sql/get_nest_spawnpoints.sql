@@ -1,5 +1,7 @@
-CREATE PROCEDURE get_nest_spawnpoints()
+CREATE OR REPLACE PROCEDURE get_nest_spawnpoints(IN minimum_spawnpoints INT, OUT discarded_nests INT)
+COMMENT '{checksum}'
 BEGIN
+SET discarded_nests = 0;
 SET SESSION TRANSACTION ISOLATION LEVEL READ UNCOMMITTED;
 -- get data
 DROP TEMPORARY TABLE IF EXISTS spawnloc;
@@ -18,7 +20,10 @@ CREATE TEMPORARY TABLE spawnloc
     FOR nest_record IN nest
     DO
       SET @spawns=(select count(*) from spawnloc WHERE ST_CONTAINS(nest_record.polygon, location));
-      UPDATE nests SET spawnpoints = @spawns, active = (CASE WHEN @spawns >= {minimum_spawnpoints} THEN 1 ELSE 0 END), discarded = (CASE WHEN @spawns < {minimum_spawnpoints} THEN 'spawnpoints' ELSE '' END) WHERE nest_id = nest_record.nest_id;
+      UPDATE nests SET spawnpoints = @spawns, active = (CASE WHEN @spawns >= minimum_spawnpoints THEN 1 ELSE 0 END), discarded = (CASE WHEN @spawns < minimum_spawnpoints THEN 'spawnpoints' ELSE '' END) WHERE nest_id = nest_record.nest_id;
+      IF @spawns < minimum_spawnpoints THEN
+        SET discarded_nests = discarded_nests + 1;
+      END IF;
     END FOR;
   END;
 DROP TEMPORARY TABLE IF EXISTS spawnloc;
@@ -1,4 +1,5 @@
-CREATE PROCEDURE nest_filter_low_coverage()
+CREATE OR REPLACE PROCEDURE nest_filter_low_coverage(IN minimum_coverage INT, OUT discarded_nests INT)
+COMMENT '{checksum}'
 BEGIN
 
 DROP TEMPORARY TABLE IF EXISTS lowCoverage;
@@ -12,9 +13,10 @@ CREATE TEMPORARY TABLE lowCoverage AS
             WHERE a.active = 1 AND (b.type = 'mon' OR b.type = 'both') AND ST_Intersects(a.polygon, b.st_lonlat)
             GROUP BY a.nest_id
         ) t
-        WHERE t.overlap < {minimum_coverage}
+        WHERE t.overlap < minimum_coverage
     );
 UPDATE nests a, lowCoverage b SET a.active = 0, discarded = 'low_coverage' WHERE a.nest_id = b.nest_id;
+SET discarded_nests = ROW_COUNT();
 DROP TEMPORARY TABLE lowCoverage;
 
 END;
\ No newline at end of file